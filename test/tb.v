@@ -22,6 +22,11 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // Generate the 10 MHz clock (100 ns period) here rather than from cocotb
+  initial clk = 1'b0;
+  always #50 clk = ~clk;
+
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -46,4 +51,7 @@ module tb ();
       .rst_n  (rst_n)     // not reset
   );
 
+  // Scalar copy of uo_out[0] so the cocotb test can wait on its edges
+  wire uo_out_0 = uo_out[0];
+
 endmodule